@@ -2,50 +2,167 @@
 
 import chess
 import random
-from copy import deepcopy
 
-from typing import List, Dict, Self
+from typing import Iterator, List, Dict, Optional, Self, Tuple
 
-pieces_list: List[chess.PieceType] = [chess.PAWN, chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN, chess.KING]
+_PAWN, _KNIGHT, _BISHOP, _ROOK, _QUEEN, _KING = chess.PAWN, chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN, chess.KING
+_WHITE, _BLACK = chess.WHITE, chess.BLACK
+
+pieces_list: List[chess.PieceType] = [_PAWN, _KNIGHT, _BISHOP, _ROOK, _QUEEN, _KING]
 pieces_name_list: List[str] = ["Pawn", "Knight", "Bishop", "Rook", "Queen", "King"]
+# Bitboard of the squares next to each square on the same rank
+adjacent_squares_bb: List[chess.Bitboard] = [chess.shift_left(bb) | chess.shift_right(bb) for bb in chess.BB_SQUARES]
+pseudo_moves_cache_size: int = 4096 # Maximum number of positions kept in the pseudo-legal moves cache of each board
+# State saved by DiceBoard._push_dice: piece bitboards (pawns to kings), occupied_co (white, black), occupied, promoted,
+# castling_rights, ep_square, custom en passant bitboards (white, black) and dice roll
+PushState = Tuple[chess.Bitboard, chess.Bitboard, chess.Bitboard, chess.Bitboard, chess.Bitboard, chess.Bitboard,
+                  chess.Bitboard, chess.Bitboard, chess.Bitboard, chess.Bitboard,
+                  chess.Bitboard, Optional[chess.Square], chess.Bitboard, chess.Bitboard, List[chess.PieceType]]
 
 class DiceBoard(chess.Board):
     def __init__(self: Self, *args, **kwargs) -> None:
         """Constructor that gives the arguments to the chess.Board constructor.
-        It initializes the dice roll as an empty list and the ep_squares dict as
-        a dictionary with empty lists of squares."""
+        It initializes the dice roll as an empty list and the en passant squares
+        of each color as empty bitboards (indexed by color)."""
         super().__init__(*args, **kwargs)
-        self.ep_squares: Dict[bool, List[chess.Square]] = {chess.WHITE: [], chess.BLACK: []}
+        self._ep_bb: List[chess.Bitboard] = [chess.BB_EMPTY, chess.BB_EMPTY]
         self.dice_roll: List[chess.PieceType] = []
+        self._pm_cache: Dict[Tuple[Optional[int], ...], List[chess.Move]] = {}
+
+    @property
+    def _dice_mask(self: Self) -> int:
+        """Bitmask of the piece types in the dice roll (bit p set if p is in the roll).
+        It is derived from dice_roll on each use, so it is never out of sync with it."""
+        dice_mask: int = 0
+        for piece_type in self.dice_roll:
+            dice_mask |= 1 << piece_type
+        return dice_mask
 
     def roll_dices(self: Self) -> None:
         """Roll the dices for the current player"""
-        self.dice_roll = random.choices(pieces_list, k=3)
+        # One draw in [0, 6^3) gives the three dices as its base 6 digits (piece types go from 1 to 6)
+        r: int = random.randrange(216)
+        self.dice_roll = [1 + r % 6, 1 + r // 6 % 6, 1 + r // 36]
     
     def copy(self: Self, *, stack: bool | int = True) -> Self:
         "Copies the content of the DiceBoard"
         board_copy: DiceBoard = super().copy(stack=stack)
-        board_copy.ep_squares = deepcopy(self.ep_squares)
+        board_copy._ep_bb = self._ep_bb[:]
         board_copy.dice_roll = self.dice_roll.copy()
+        # Entries are keyed by the full position, so the cache is valid for the copy too
+        board_copy._pm_cache = self._pm_cache
         return board_copy
 
+    def _push_dice(self: Self, move: chess.Move) -> PushState:
+        """Make a pseudo-legal move for the move search, working on the bitboards directly.
+        Like push with make_changes, the dices and the en passant squares are updated and the
+        turn is kept, but nothing goes to the move stack. Returns the state needed by _pop_dice."""
+        color: chess.Color = self.turn
+        opponent: chess.Color = not color
+        state: PushState = (self.pawns, self.knights, self.bishops, self.rooks, self.queens, self.kings,
+                            self.occupied_co[_WHITE], self.occupied_co[_BLACK], self.occupied, self.promoted,
+                            self.castling_rights, self.ep_square, self._ep_bb[_WHITE], self._ep_bb[_BLACK], self.dice_roll)
+
+        # Like push, no standard en passant is left for the following moves of the turn
+        ep_square: Optional[chess.Square] = self.ep_square
+        self.ep_square = None
+
+        move = self._to_chess960(move)
+        from_bb: chess.Bitboard = chess.BB_SQUARES[move.from_square]
+        to_bb: chess.Bitboard = chess.BB_SQUARES[move.to_square]
+        piece_type: None | chess.PieceType = self._remove_piece_at(move.from_square)
+        assert not piece_type is None, f"Trying to start move '{move}' from empty square."
+        castling: bool = piece_type == _KING and bool(self.occupied_co[color] & to_bb) # The move goes from the king to the rook
+        self.dice_roll = self.dice_roll.copy()
+        try:
+            self.dice_roll.remove(piece_type)
+            if castling:
+                self.dice_roll.remove(_ROOK)
+        except ValueError:
+            pass
+
+        # Castling rights are lost when the king moves, when a rook leaves or is captured on its square
+        # or when the opponent king is captured on its back rank
+        our_back_rank: chess.Bitboard = chess.BB_RANK_1 if color == _WHITE else chess.BB_RANK_8
+        opponent_back_rank: chess.Bitboard = chess.BB_RANK_8 if color == _WHITE else chess.BB_RANK_1
+        self.castling_rights &= ~to_bb & ~from_bb
+        if piece_type == _KING:
+            self.castling_rights &= ~our_back_rank
+        elif self.kings & self.occupied_co[opponent] & to_bb & opponent_back_rank:
+            self.castling_rights &= ~opponent_back_rank
+
+        if piece_type == _PAWN:
+            diff: int = move.to_square - move.from_square
+            if (self._ep_bb[color] & to_bb or move.to_square == ep_square) and not self.occupied & to_bb:
+                # Custom (or standard, for a position loaded from FEN) en passant capture
+                self._ep_bb[color] &= ~to_bb
+                if diff in (7, 9, -7, -9):
+                    self._remove_piece_at(move.to_square - 8 if color == _WHITE else move.to_square + 8)
+            if diff in (16, -16) and self.pawns & self.occupied_co[opponent] & adjacent_squares_bb[move.to_square]:
+                self._ep_bb[opponent] |= chess.BB_SQUARES[(move.from_square + move.to_square) // 2]
+            if move.promotion:
+                piece_type = move.promotion
+
+        if castling:
+            self._remove_piece_at(move.to_square)
+            if move.to_square < move.from_square:
+                self._set_piece_at(chess.C1 if color == _WHITE else chess.C8, _KING, color)
+                self._set_piece_at(chess.D1 if color == _WHITE else chess.D8, _ROOK, color)
+            else:
+                self._set_piece_at(chess.G1 if color == _WHITE else chess.G8, _KING, color)
+                self._set_piece_at(chess.F1 if color == _WHITE else chess.F8, _ROOK, color)
+        else:
+            self._set_piece_at(move.to_square, piece_type, color)
+
+        return state
+
+    def _pop_dice(self: Self, state: PushState) -> None:
+        """Undo a move made with _push_dice from the state it returned."""
+        (self.pawns, self.knights, self.bishops, self.rooks, self.queens, self.kings,
+         self.occupied_co[_WHITE], self.occupied_co[_BLACK], self.occupied, self.promoted,
+         self.castling_rights, self.ep_square, self._ep_bb[_WHITE], self._ep_bb[_BLACK], self.dice_roll) = state
+
+    def _dice_from_mask(self: Self) -> chess.Bitboard:
+        """Bitboard of the squares of our pieces whose type is in the dice."""
+        dice_mask: int = self._dice_mask
+        from_mask: chess.Bitboard = chess.BB_EMPTY
+        for piece_type in pieces_list:
+            if (dice_mask >> piece_type) & 1:
+                from_mask |= self.pieces_mask(piece_type, self.turn)
+        return from_mask
+
+    def _iter_pseudo_moves(self: Self) -> Iterator[Tuple[chess.Move, chess.PieceType, bool]]:
+        """Yield (move, piece_type, is_castling) for the moves compatible with the dices,
+        so callers do not need to look up the moving piece or the castling flag again."""
+        dice_mask: int = self._dice_mask
+        castling_mask: int = (1 << _KING) | (1 << _ROOK)
+        can_castle: bool = dice_mask & castling_mask == castling_mask
+
+        for move in self._get_pseudo_legal_moves_dice(self._dice_from_mask()):
+            # Moves start from _dice_from_mask, which only holds occupied squares, so there is always a piece
+            piece_type: chess.PieceType = self.piece_type_at(move.from_square) # pyright: ignore[reportAssignmentType]
+            castling: bool = piece_type == _KING and self.is_castling(move)
+            if not castling or can_castle:
+                yield move, piece_type, castling
+
     def _get_pseudo_moves(self: Self) -> List[chess.Move]:
         """Get possible moves compatible with the dices.
         If there is only one piece left these are all the possible moves."""
-        return [move for move in self._get_pseudo_legal_moves_dice() if
-                ((not (castling := self.is_castling(move))) and (piece := self.piece_at(move.from_square))
-                 and (piece.piece_type in self.dice_roll)) or (castling and chess.KING in self.dice_roll and chess.ROOK in self.dice_roll)]
+        return [move for move, _, _ in self._iter_pseudo_moves()]
     
     def _get_moves_3(self: Self) -> List[chess.Move]:
         """Get possible moves when there are three reamining pieces in the dice."""
-        pseudo_moves: List[chess.Move] = self._get_pseudo_moves()
+        pseudo_moves: List[Tuple[chess.Move, chess.PieceType, bool]] = list(self._iter_pseudo_moves())
         count_list: List[int] = [1 for _ in pseudo_moves]
         max_count: int = 1
-        for i, move in enumerate(pseudo_moves):
-            board_p1: DiceBoard = self.copy(stack=False)
-            board_p1.push(move, make_changes = True)
-            pseudo_moves_p1: List[chess.Move] = board_p1._get_pseudo_moves()
-            if self.is_castling(move):
+
+        # First pass: one ply for every move, keeping the follow-up moves of those that reach two moves
+        pending: List[Tuple[int, chess.Move, List[Tuple[chess.Move, chess.PieceType, bool]]]] = []
+        for i, (move, _, castling) in enumerate(pseudo_moves):
+            state: PushState = self._push_dice(move)
+            pseudo_moves_p1: List[Tuple[chess.Move, chess.PieceType, bool]] = list(self._iter_pseudo_moves())
+            self._pop_dice(state)
+            if castling:
                 count_list[i] = 2
                 if max_count < 2:
                     max_count = 2
@@ -56,40 +173,60 @@ class DiceBoard(chess.Board):
                 count_list[i] = 2
                 if max_count < 2:
                     max_count = 2
-                for move_p1 in pseudo_moves_p1:
-                    if board_p1.is_castling(move_p1):
-                        count_list[i] = 3
-                        max_count = 3
-                        break
-                    
-                    board_p2: DiceBoard = board_p1.copy(stack=False)
-                    board_p2.push(move_p1, make_changes = True)
-                    pseudo_moves_p2: List[chess.Move] = board_p2._get_pseudo_moves()
-                    if len(pseudo_moves_p2) > 0:
-                        count_list[i] = 3
-                        max_count = 3
-                        break # If there are three moves already (starting from our original move) we stop checking the other options
+                if any(castling_p1 for _, _, castling_p1 in pseudo_moves_p1):
+                    count_list[i] = 3
+                    max_count = 3
+                else:
+                    pending.append((i, move, pseudo_moves_p1))
+
+        # Second pass: only the moves tied at two need the second ply
+        for i, move, pseudo_moves_p1 in pending:
+            state: PushState = self._push_dice(move)
+
+            # Try first the follow-ups that leave in the dice the piece type we have the most pieces of
+            last_dice: Dict[chess.PieceType, chess.PieceType] = {}
+            piece_count: Dict[chess.PieceType, int] = {}
+            for piece_type_p1 in set(self.dice_roll):
+                remaining: List[chess.PieceType] = self.dice_roll.copy()
+                remaining.remove(piece_type_p1)
+                last_dice[piece_type_p1] = remaining[0]
+                piece_count[piece_type_p1] = chess.popcount(self.pieces_mask(remaining[0], self.turn))
+            pseudo_moves_p1.sort(key=lambda move_info: -piece_count[move_info[1]])
+
+            for move_p1, piece_type_p1, _ in pseudo_moves_p1:
+                if piece_count[piece_type_p1] == 0 and move_p1.promotion != last_dice[piece_type_p1]:
+                    continue # No piece left for the last dice, so there can be no third move
+                state_p1: PushState = self._push_dice(move_p1)
+                has_move_p2: bool = next(self._iter_pseudo_moves(), None) is not None
+                self._pop_dice(state_p1)
+                if has_move_p2:
+                    count_list[i] = 3
+                    max_count = 3
+                    break # If there are three moves already (starting from our original move) we stop checking the other options
+            self._pop_dice(state)
         
-        return [move for move, count in zip(pseudo_moves, count_list) if count == max_count or ((captured := self.piece_at(move.to_square)) and captured.piece_type == chess.KING)]
+        opponent_kings: chess.Bitboard = self.kings & self.occupied_co[not self.turn]
+        return [move for (move, _, _), count in zip(pseudo_moves, count_list) if count == max_count or chess.BB_SQUARES[move.to_square] & opponent_kings]
     
     def _get_moves_2(self: Self) -> List[chess.Move]:
         """Get possible moves when there are two reamining pieces in the dice."""
-        pseudo_moves: List[chess.Move] = self._get_pseudo_moves()
+        pseudo_moves: List[Tuple[chess.Move, chess.PieceType, bool]] = list(self._iter_pseudo_moves())
         count_list: List[int] = [1 for _ in pseudo_moves]
         max_count: int = 1
-        for i, move in enumerate(pseudo_moves):
-            if self.is_castling(move):
+        for i, (move, _, castling) in enumerate(pseudo_moves):
+            if castling:
                 count_list[i] = 2
                 max_count = 2
             else:
-                board_p1: DiceBoard = self.copy(stack=False)
-                board_p1.push(move, make_changes = True)
-                pseudo_moves_p1: List[chess.Move] = board_p1._get_pseudo_moves()
-                if len(pseudo_moves_p1) > 0:
+                state: PushState = self._push_dice(move)
+                has_move_p1: bool = next(self._iter_pseudo_moves(), None) is not None
+                self._pop_dice(state)
+                if has_move_p1:
                     count_list[i] = 2
                     max_count = 2
         
-        return [move for move, count in zip(pseudo_moves, count_list) if count == max_count or ((captured := self.piece_at(move.to_square)) and captured.piece_type == chess.KING)]
+        opponent_kings: chess.Bitboard = self.kings & self.occupied_co[not self.turn]
+        return [move for (move, _, _), count in zip(pseudo_moves, count_list) if count == max_count or chess.BB_SQUARES[move.to_square] & opponent_kings]
 
     def get_moves(self: Self) -> List[chess.Move]:
         """Get possible moves in current position"""
@@ -114,20 +251,20 @@ class DiceBoard(chess.Board):
         assert not piece is None, f"Trying to start move '{move}' from empty square."
 
         is_castling: bool = self.is_castling(move)
-        is_pawn: bool = piece.piece_type == chess.PAWN
+        is_pawn: bool = piece.piece_type == _PAWN
 
         # Detect custom en passant captures
         if (
             is_pawn
-            and move.to_square in self.ep_squares[color]
+            and self._ep_bb[color] & chess.BB_SQUARES[move.to_square]
             and not self.piece_at(move.to_square)  # target is empty
         ):
             # Change capture square for base class
             self.ep_square = move.to_square
 
-            # Remove ep square from dict
+            # Remove ep square from the bitboard
             if make_changes:
-                self.ep_squares[color].remove(move.to_square)
+                self._ep_bb[color] &= ~chess.BB_SQUARES[move.to_square]
 
         # Execute the move normally
         super().push(move)
@@ -138,66 +275,54 @@ class DiceBoard(chess.Board):
             try:
                 self.dice_roll.remove(piece.piece_type)
                 if is_castling:
-                    self.dice_roll.remove(chess.ROOK)
+                    self.dice_roll.remove(_ROOK)
             except ValueError:
                 pass
 
         # Handle new en passant rights
         if is_pawn and make_changes:
-            from_rank: int = chess.square_rank(move.from_square)
-            to_rank: int = chess.square_rank(move.to_square)
-            if abs(to_rank - from_rank) == 2:
+            if abs(move.to_square - move.from_square) == 16: # Double push: two ranks on the same file
                 ep_sq = (move.from_square + move.to_square) // 2
         
-                # Check for adjacent opponent pawns before granting EP right
-                to_file: int = chess.square_file(move.to_square)
-                to_rank: int = chess.square_rank(move.to_square)
-        
-                has_adjacent_opponent_pawn: bool = False
-                for side_file in (to_file - 1, to_file + 1):
-                    if 0 <= side_file <= 7:  # stay on board
-                        neighbor_sq: chess.Square = chess.square(side_file, to_rank)
-                        piece: None | chess.Piece = self.piece_at(neighbor_sq)
-                        if piece and piece.piece_type == chess.PAWN and piece.color == opponent:
-                            has_adjacent_opponent_pawn = True
-                            break
-        
                 # Only add EP square if opponent pawn adjacent
-                if has_adjacent_opponent_pawn and not ep_sq in self.ep_squares[opponent]:
-                    self.ep_squares[opponent].append(ep_sq)
+                if self.pawns & self.occupied_co[opponent] & adjacent_squares_bb[move.to_square]:
+                    self._ep_bb[opponent] |= chess.BB_SQUARES[ep_sq]
     
-    def _get_pseudo_legal_moves_dice(self: Self) -> List[chess.Move]:
-        """All standard pseudo-legal moves + custom en passant moves."""
-        moves: List[chess.Move] = list(self.pseudo_legal_moves)
+    def _position_key(self: Self) -> Tuple[Optional[int], ...]:
+        """Key identifying everything the moves of the side to move depend on, except the dices."""
+        return (self.pawns, self.knights, self.bishops, self.rooks, self.queens, self.kings,
+                self.occupied_co[_WHITE], self.occupied_co[_BLACK], self.turn,
+                self.castling_rights, self.ep_square, self._ep_bb[self.turn])
+
+    def _get_pseudo_legal_moves_dice(self: Self, from_mask: chess.Bitboard = chess.BB_ALL) -> List[chess.Move]:
+        """All standard pseudo-legal moves + custom en passant moves starting from a square in from_mask.
+        The result is cached by position, so the returned list must not be modified."""
+        key: Tuple[Optional[int], ...] = self._position_key() + (from_mask,)
+        moves: None | List[chess.Move] = self._pm_cache.get(key)
+        if moves is None:
+            if len(self._pm_cache) >= pseudo_moves_cache_size:
+                del self._pm_cache[next(iter(self._pm_cache))] # Evict the oldest entry
+            moves = self._pm_cache[key] = self._generate_pseudo_legal_moves_dice(from_mask)
+        return moves
+
+    def _generate_pseudo_legal_moves_dice(self: Self, from_mask: chess.Bitboard) -> List[chess.Move]:
+        """Generate the standard pseudo-legal moves + custom en passant moves starting from a square in from_mask."""
+        moves: List[chess.Move] = list(self.generate_pseudo_legal_moves(from_mask))
         color: chess.Color = self.turn
+        if not self._ep_bb[color]:
+            return moves # Usual case: there are no custom en passant squares for this side
         opponent: chess.Color = not color
 
-        # Add all custom en passant moves for this side
-        for ep_sq in self.ep_squares[color]:
-            if not self.piece_at(ep_sq) is None:
-                continue # If there is a piece in the en passant square we capture this piece
-
-            # Rank of target square (where capturing pawn will land)
-            ep_rank: int = chess.square_rank(ep_sq)
-            ep_file: int = chess.square_file(ep_sq)
-
-            # Direction depends on side to move
-            direction: int = 1 if color == chess.WHITE else -1
-            captured_sq: chess.Square = chess.square(ep_file, ep_rank - direction)
-
-            # For each side-adjacent file, check for capturing pawn
-            for df in (-1, 1):
-                pawn_file: int = ep_file + df
-                if 0 <= pawn_file <= 7:
-                    pawn_sq: chess.Square = chess.square(pawn_file, ep_rank - direction)
-                    piece: None | chess.Piece = self.piece_at(pawn_sq)
-                    if piece and piece.piece_type == chess.PAWN and piece.color == color:
-                        # Create en passant move
-                        move: chess.Move = chess.Move(pawn_sq, ep_sq)
-                        # Double-check that the captured square really contains an opponent pawn
-                        captured_piece: None | chess.Piece = self.piece_at(captured_sq)
-                        if captured_piece and captured_piece.piece_type == chess.PAWN and captured_piece.color == opponent:
-                            moves.append(move)
+        # Add all custom en passant moves for this side: the en passant square has to be empty
+        # and right behind an opponent pawn (the captured one)
+        opponent_pawns: chess.Bitboard = self.pawns & self.occupied_co[opponent]
+        behind_opponent_pawns: chess.Bitboard = (opponent_pawns << 8 if color == _WHITE else opponent_pawns >> 8) & chess.BB_ALL
+        ep_targets: chess.Bitboard = self._ep_bb[color] & ~self.occupied & behind_opponent_pawns
+        our_pawns: chess.Bitboard = self.pawns & self.occupied_co[color] & from_mask
+        for ep_sq in chess.scan_forward(ep_targets):
+            # Our pawns attacking the en passant square are the ones an opponent pawn on it would attack
+            for pawn_sq in chess.scan_forward(chess.BB_PAWN_ATTACKS[opponent][ep_sq] & our_pawns):
+                moves.append(chess.Move(pawn_sq, ep_sq))
 
         return moves
 
@@ -223,10 +348,10 @@ class DiceBoard(chess.Board):
         color: chess.Color = self.turn
     
         # Check if this move is a custom en passant capture
-        is_pawn: bool = (not (piece := self.piece_at(move.from_square)) is None) and piece.piece_type == chess.PAWN
+        is_pawn: bool = (not (piece := self.piece_at(move.from_square)) is None) and piece.piece_type == _PAWN
         if (
             is_pawn
-            and move.to_square in self.ep_squares[color]
+            and self._ep_bb[color] & chess.BB_SQUARES[move.to_square]
             and not self.piece_at(move.to_square)
         ):
             # Temporarily tell python-chess that this is an en passant move
@@ -242,14 +367,14 @@ class DiceBoard(chess.Board):
     def is_game_over(self: Self, move: chess.Move) -> bool: # pyright: ignore[reportIncompatibleMethodOverride]
         """Check if the move ends the game (king capture)"""
         captured: None | chess.Piece = self.piece_at(move.to_square)
-        if captured and captured.piece_type == chess.KING:
+        if captured and captured.piece_type == _KING:
             return True
         return False
 
     def next_player(self: Self) -> None:
         """Change to the next player"""
         color: chess.Color = self.turn
-        self.ep_squares[color] = []
+        self._ep_bb[color] = chess.BB_EMPTY
         self.turn = not color
 
 def main() -> None: